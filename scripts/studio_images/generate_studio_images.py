@@ -10,24 +10,53 @@ from __future__ import annotations
 
 import argparse
 import base64
+import gzip
+import hashlib
+import json
 import mimetypes
 import os
 import random
 import time
-from dataclasses import dataclass
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
 from io import BytesIO
 from pathlib import Path
 import statistics
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import dotenv_values, find_dotenv, load_dotenv
 from PIL import Image
 from PIL import ImageChops
+from PIL import ImageDraw
+from PIL import ImageFilter
 
 
 DEFAULT_MODEL = "gemini-2.5-flash-image"
 
+DEFAULT_UPLOAD_ENDPOINT = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+DEFAULT_FILES_CACHE = Path(__file__).resolve().parent / ".files_api_cache.json"
+DEFAULT_WATCH_STATE = Path(__file__).resolve().parent / ".watch_state.json"
+# --watch retries a failed input after WATCH_RETRY_BASE_S, then 4x longer each time.
+WATCH_RETRY_BASE_S = 15 * 60
+WATCH_MAX_ATTEMPTS = 3
+# Files API uploads are kept for 48h; treat cached URIs as expired a bit early.
+FILES_API_TTL_S = 48 * 3600
+FILES_API_EXPIRY_MARGIN_S = 3600
+
+# Background flattening is skipped unless the estimated background is at least this bright (per channel).
+FLATTEN_MIN_BG_LEVEL = 200
+# Flatten cutoff cap (max-channel diff levels), kept well below the crop noise clamp so light petals survive.
+FLATTEN_MAX_THRESHOLD = 24
+# Downscale factor for the border flood fill in _border_connected.
+FLATTEN_COARSE_SCALE = 4
+
+# Approximate published pricing for gemini-2.5-flash-image (USD per 1M tokens).
+# Only used for the --max-cost budget / summary estimate; override via CLI.
+DEFAULT_INPUT_COST_PER_MTOK = 0.30
+DEFAULT_OUTPUT_COST_PER_MTOK = 30.0
+
 
 DEFAULT_PROMPT = """\
 Create a clean studio product photo of a single plant.
@@ -230,6 +259,150 @@ def _resolve_single_input_path(
     return chosen
 
 
+def _load_priority_ranks(list_path: Path) -> Dict[str, int]:
+    """
+    Load a priority list (same line format as --input-list, e.g. the output of
+    select_pa_missing_studio_images.js) into a stem -> rank map (0 = highest priority).
+    """
+    if not list_path.exists():
+        raise FileNotFoundError(f"Priority list not found: {list_path}")
+
+    ranks: Dict[str, int] = {}
+    for raw in list_path.read_text(encoding="utf-8").splitlines():
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        stem = _safe_stem(Path(line).name)
+        if stem and stem not in ranks:
+            ranks[stem] = len(ranks)
+    return ranks
+
+
+# Scheduling order for output states: never-generated images first, then outputs older than their input.
+_STATUS_ORDER = {"missing": 0, "stale": 1, "current": 2}
+
+
+def _output_status(img_path: Path, existing: List[Path]) -> str:
+    """
+    Classify an input by its existing outputs:
+    - missing: no output yet
+    - stale: an output exists but is older than the input photo
+    - current: an output exists and is up to date
+    """
+    if not existing:
+        return "missing"
+    try:
+        input_mtime = img_path.stat().st_mtime
+        if all(p.stat().st_mtime < input_mtime for p in existing):
+            return "stale"
+    except OSError:
+        pass
+    return "current"
+
+
+def _schedule_inputs(
+    inputs: List[Path],
+    *,
+    output_dir: Path,
+    priority_ranks: Dict[str, int],
+) -> List[Path]:
+    """
+    Order inputs so the highest-value work runs first (and survives --limit / budget cutoffs):
+    1. rank in the priority list (unlisted images go last)
+    2. missing outputs before stale outputs before current ones
+    Ties keep the incoming order (sorted filenames, or --input-list order).
+    """
+    unlisted = len(priority_ranks)
+
+    def _key(p: Path) -> Tuple[int, int]:
+        existing = [c for c in _candidate_outputs(output_dir, p.name) if c.exists()]
+        return (
+            priority_ranks.get(_safe_stem(p.name), unlisted),
+            _STATUS_ORDER[_output_status(p, existing)],
+        )
+
+    return sorted(inputs, key=_key)
+
+
+class BudgetExhausted(Exception):
+    """Raised instead of sending a request once the per-run request budget is spent."""
+
+
+@dataclass
+class UsageTracker:
+    """
+    Accumulates `usageMetadata` from generateContent responses and enforces the
+    optional per-run budget (--max-requests / --max-cost).
+
+    `requests` counts every attempted generation request (including failed attempts and
+    retries) and is what --max-requests caps; tokens and cost come from successful
+    `responses` only.
+    """
+
+    input_cost_per_mtok: float = DEFAULT_INPUT_COST_PER_MTOK
+    output_cost_per_mtok: float = DEFAULT_OUTPUT_COST_PER_MTOK
+    max_requests: int = 0
+    max_cost: float = 0.0
+    requests: int = 0
+    responses: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    total_tokens: int = 0
+
+    def _cost_of(self, prompt_tokens: int, output_tokens: int) -> float:
+        return (
+            prompt_tokens * self.input_cost_per_mtok + output_tokens * self.output_cost_per_mtok
+        ) / 1_000_000
+
+    @property
+    def cost(self) -> float:
+        return self._cost_of(self.prompt_tokens, self.output_tokens)
+
+    def record(self, resp_json: Dict[str, Any]) -> Dict[str, Any]:
+        """Count one successful response and its token usage; returns the per-response usage (with estimated cost)."""
+        meta = resp_json.get("usageMetadata") or resp_json.get("usage_metadata") or {}
+        if not isinstance(meta, dict):
+            meta = {}
+        prompt = int(meta.get("promptTokenCount") or 0)
+        # Thinking tokens (if any) are billed as output.
+        output = int(meta.get("candidatesTokenCount") or 0) + int(meta.get("thoughtsTokenCount") or 0)
+        total = int(meta.get("totalTokenCount") or (prompt + output))
+
+        self.responses += 1
+        self.prompt_tokens += prompt
+        self.output_tokens += output
+        self.total_tokens += total
+        return {
+            "prompt_tokens": prompt,
+            "output_tokens": output,
+            "total_tokens": total,
+            "cost": round(self._cost_of(prompt, output), 6),
+        }
+
+    def record_attempt(self) -> None:
+        """Count one attempted request; raises BudgetExhausted instead if --max-requests is already spent."""
+        if self.max_requests > 0 and self.requests >= self.max_requests:
+            raise BudgetExhausted(f"request budget spent ({self.requests}/{self.max_requests})")
+        self.requests += 1
+
+    def exhausted(self) -> Optional[str]:
+        """Return a reason string once the budget is spent, else None."""
+        if self.max_requests > 0 and self.requests >= self.max_requests:
+            return f"request budget spent ({self.requests}/{self.max_requests})"
+        if self.max_cost > 0:
+            # Project the next request from the running average so we stop before overshooting.
+            next_cost = self.cost / self.responses if self.responses else 0.0
+            if self.cost + next_cost > self.max_cost:
+                return f"cost budget spent (${self.cost:.4f} of ${self.max_cost:.4f})"
+        return None
+
+
+def _append_usage_log(log_path: Path, entry: Dict[str, Any]) -> None:
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with log_path.open("a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
 @dataclass
 class GeminiImagePart:
     mime_type: str
@@ -267,23 +440,169 @@ def _extract_image_part(resp_json: Dict[str, Any]) -> GeminiImagePart:
     raise ValueError("No inline image part found in response content.parts.")
 
 
-def _build_payload(prompt: str, image_mime: str, image_bytes: bytes) -> Dict[str, Any]:
-    # REST JSON uses inline_data with { mime_type, data(base64) }
-    return {
-        "contents": [
-            {
-                "parts": [
-                    {"text": prompt},
-                    {
-                        "inline_data": {
-                            "mime_type": image_mime,
-                            "data": _b64encode_bytes(image_bytes),
-                        }
-                    },
-                ]
-            }
-        ]
+def _build_payload(
+    prompt: str,
+    image_mime: str,
+    image_bytes: bytes,
+    file_uri: Optional[str] = None,
+) -> Dict[str, Any]:
+    # REST JSON uses inline_data with { mime_type, data(base64) },
+    # or file_data with { mime_type, file_uri } for inputs uploaded via the Files API.
+    if file_uri:
+        image_part: Dict[str, Any] = {"file_data": {"mime_type": image_mime, "file_uri": file_uri}}
+    else:
+        image_part = {"inline_data": {"mime_type": image_mime, "data": _b64encode_bytes(image_bytes)}}
+    return {"contents": [{"parts": [{"text": prompt}, image_part]}]}
+
+
+def _load_files_cache(cache_path: Path) -> Dict[str, Dict[str, Any]]:
+    """Load the sha256 -> uploaded file map; a missing or corrupt cache is treated as empty."""
+    try:
+        data = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _save_files_cache(cache_path: Path, cache: Dict[str, Dict[str, Any]]) -> None:
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_path.with_suffix(cache_path.suffix + ".tmp")
+    tmp.write_text(json.dumps(cache, indent=2, sort_keys=True), encoding="utf-8")
+    tmp.replace(cache_path)
+
+
+def _parse_expiration(value: Any) -> Optional[float]:
+    """Parse a Files API expirationTime (RFC 3339, possibly with nanoseconds) to epoch seconds."""
+    if not isinstance(value, str) or not value:
+        return None
+    # Drop fractional seconds / zone suffix; the API reports UTC.
+    base = value.split(".")[0].rstrip("Z")
+    try:
+        return datetime.strptime(base, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def _upload_file(
+    *,
+    session: requests.Session,
+    upload_url: str,
+    api_key: str,
+    data: bytes,
+    mime_type: str,
+    display_name: str,
+    timeout_s: int,
+) -> Dict[str, Any]:
+    """
+    Upload bytes via the Gemini Files API (resumable protocol: start, then upload+finalize).
+    Returns the `file` resource ({ name, uri, mimeType, expirationTime, ... }).
+    """
+    start = session.post(
+        upload_url,
+        headers={
+            "x-goog-api-key": api_key,
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(data)),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+            "Content-Type": "application/json",
+        },
+        json={"file": {"display_name": display_name}},
+        timeout=timeout_s,
+    )
+    if start.status_code < 200 or start.status_code >= 300:
+        raise RuntimeError(f"Upload start HTTP {start.status_code}: {start.text[:500]}")
+    session_url = start.headers.get("X-Goog-Upload-URL") or start.headers.get("x-goog-upload-url")
+    if not session_url:
+        raise RuntimeError("Upload start response did not include an upload URL.")
+
+    r = session.post(
+        session_url,
+        headers={
+            "Content-Length": str(len(data)),
+            "X-Goog-Upload-Offset": "0",
+            "X-Goog-Upload-Command": "upload, finalize",
+        },
+        data=data,
+        timeout=timeout_s,
+    )
+    if r.status_code < 200 or r.status_code >= 300:
+        raise RuntimeError(f"Upload HTTP {r.status_code}: {r.text[:500]}")
+    file_info = (r.json() or {}).get("file") or {}
+    if not file_info.get("uri"):
+        raise RuntimeError("Upload response did not include a file uri.")
+    return file_info
+
+
+def _is_file_reference_error(err: BaseException, *, file_uri: str, file_name: str = "") -> bool:
+    """
+    True if a failed generateContent call was rejected because of the file_data reference
+    (expired/deleted/forbidden upload): a 400/403/404 whose body names the file. Rate limits,
+    5xx, timeouts and unrelated 4xx (bad prompt/arguments, bad API key) return False.
+    """
+    cause = err.__cause__ if err.__cause__ is not None else err
+    if not isinstance(cause, HttpStatusError) or cause.status_code not in (400, 403, 404):
+        return False
+    body = cause.body or ""
+    needles = [file_uri, "file_uri", "fileUri"]
+    if file_name:
+        # e.g. "files/abc123"; error messages sometimes quote only the id.
+        needles += [file_name, file_name.rsplit("/", 1)[-1]]
+    return any(n and n in body for n in needles)
+
+
+def _get_or_upload_file(
+    *,
+    session: requests.Session,
+    cache: Dict[str, Dict[str, Any]],
+    cache_path: Path,
+    digest: str,
+    upload_url: str,
+    api_key: str,
+    data: bytes,
+    mime_type: str,
+    display_name: str,
+    timeout_s: int,
+    max_retries: int,
+    base_sleep_s: float,
+) -> str:
+    """
+    Return a Files API URI for `data`, reusing a cached, unexpired upload of the same
+    content hash (across retries and reruns) and uploading once otherwise.
+    """
+    entry = cache.get(digest)
+    if entry and float(entry.get("expires_at") or 0) - FILES_API_EXPIRY_MARGIN_S > time.time():
+        return str(entry["uri"])
+
+    file_info: Dict[str, Any] = {}
+    for attempt in range(max_retries + 1):
+        try:
+            file_info = _upload_file(
+                session=session,
+                upload_url=upload_url,
+                api_key=api_key,
+                data=data,
+                mime_type=mime_type,
+                display_name=display_name,
+                timeout_s=timeout_s,
+            )
+            break
+        except Exception as e:
+            if attempt >= max_retries:
+                raise RuntimeError(f"Upload failed after {max_retries + 1} attempts: {e}") from e
+            # Exponential backoff with jitter
+            sleep_s = base_sleep_s * (2**attempt) + random.uniform(0, 0.25)
+            time.sleep(sleep_s)
+
+    cache[digest] = {
+        "uri": file_info["uri"],
+        "name": file_info.get("name"),
+        "mime_type": file_info.get("mimeType") or mime_type,
+        "size": len(data),
+        "expires_at": _parse_expiration(file_info.get("expirationTime")) or (time.time() + FILES_API_TTL_S),
     }
+    _save_files_cache(cache_path, cache)
+    return str(file_info["uri"])
 
 
 def _render_prompt(prompt_template: str, scientific_name: str) -> str:
@@ -298,28 +617,81 @@ def _render_prompt(prompt_template: str, scientific_name: str) -> str:
     return f"{prompt_template.rstrip()}\n\nScientific name (species): {scientific_name}\n"
 
 
+class HttpStatusError(RuntimeError):
+    """Non-2xx response from the API; keeps the status code and body for callers that branch on them."""
+
+    def __init__(self, status_code: int, message: str, body: str = "") -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+def _make_session(pool_maxsize: int = 1) -> requests.Session:
+    """
+    Shared keep-alive session for the whole run, so every request after the first reuses
+    the pooled TLS connection instead of reconnecting. Generation is sequential, so one
+    connection per host is enough.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, pool_maxsize))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _connection_stats(session: requests.Session) -> Tuple[int, int]:
+    """Return (connections opened, requests sent) across the session's connection pools."""
+    opened = 0
+    sent = 0
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+        poolmanager = getattr(adapter, "poolmanager", None)
+        if poolmanager is None:
+            continue
+        for key in list(poolmanager.pools.keys()):
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            opened += int(getattr(pool, "num_connections", 0))
+            sent += int(getattr(pool, "num_requests", 0))
+    return opened, sent
+
+
 def _request_with_retries(
     *,
+    session: requests.Session,
     url: str,
     api_key: str,
     payload: Dict[str, Any],
     timeout_s: int,
     max_retries: int,
     base_sleep_s: float,
+    gzip_body: bool = False,
+    before_attempt: Optional[Callable[[], None]] = None,
 ) -> Dict[str, Any]:
+    """
+    POST `payload` with retries. `before_attempt` runs before every attempt (e.g. to count it
+    against the request budget); anything it raises propagates without further retries.
+    """
     headers = {
         "Content-Type": "application/json",
         "x-goog-api-key": api_key,
     }
+    # Serialize (and optionally compress) once; retries resend the same bytes.
+    body = json.dumps(payload).encode("utf-8")
+    if gzip_body:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
 
     last_err: Optional[Exception] = None
     for attempt in range(max_retries + 1):
+        if before_attempt is not None:
+            before_attempt()
         try:
-            r = requests.post(url, headers=headers, json=payload, timeout=timeout_s)
+            r = session.post(url, headers=headers, data=body, timeout=timeout_s)
             if r.status_code in (429, 500, 502, 503, 504):
-                raise RuntimeError(f"Transient HTTP {r.status_code}: {r.text[:500]}")
+                raise HttpStatusError(r.status_code, f"Transient HTTP {r.status_code}: {r.text[:500]}", r.text)
             if r.status_code < 200 or r.status_code >= 300:
-                raise RuntimeError(f"HTTP {r.status_code}: {r.text[:1000]}")
+                raise HttpStatusError(r.status_code, f"HTTP {r.status_code}: {r.text[:1000]}", r.text)
             return r.json()
         except Exception as e:
             last_err = e
@@ -345,6 +717,64 @@ def _choose_output_path(
     return output_dir / input_filename
 
 
+def _estimate_background(
+    rgb: Image.Image,
+) -> Optional[Tuple[Tuple[int, int, int], Image.Image, Optional[int], Tuple[int, int, int, int]]]:
+    """
+    Estimate the background color from the *whitest* corner patch (to avoid cases where a
+    corner includes plant pixels).
+
+    Returns (bg_color, diff, auto_thr, noise_box), where diff is the per-pixel "L" difference
+    from bg_color, auto_thr is a noise-adaptive cutoff measured on the chosen patch (None if
+    the patch was empty) and noise_box is that patch. Returns None if no corner could be sampled.
+    """
+    w, h = rgb.size
+    patch = max(6, min(24, min(w, h) // 18))
+    corners: list[tuple[int, int]] = [(0, 0), (w - patch, 0), (0, h - patch), (w - patch, h - patch)]
+
+    best_bg: Optional[tuple[int, int, int]] = None
+    best_corner = corners[0]
+    best_luma: float = -1.0
+
+    for cx, cy in corners:
+        crop = rgb.crop((cx, cy, cx + patch, cy + patch))
+        data = list(crop.getdata())
+        if not data:
+            continue
+        rs = [p[0] for p in data]
+        gs = [p[1] for p in data]
+        bs = [p[2] for p in data]
+        bg = (
+            int(statistics.median(rs)),
+            int(statistics.median(gs)),
+            int(statistics.median(bs)),
+        )
+        luma = (bg[0] + bg[1] + bg[2]) / 3.0
+        if luma > best_luma:
+            best_luma = luma
+            best_bg = bg
+            best_corner = (cx, cy)
+
+    if not best_bg:
+        return None
+
+    bg_img = Image.new("RGB", rgb.size, best_bg)
+    diff = ImageChops.difference(rgb, bg_img).convert("L")
+    # Auto-adapt threshold based on how noisy the background is in the chosen corner patch.
+    # This prevents faint gray haze / gradients from being mistaken as "foreground".
+    corner_x, corner_y = best_corner
+    noise_box = (corner_x, corner_y, corner_x + patch, corner_y + patch)
+    noise_patch = diff.crop(noise_box)
+    noise_vals = list(noise_patch.getdata())
+    auto_thr: Optional[int] = None
+    if noise_vals:
+        med = float(statistics.median(noise_vals))
+        mad = float(statistics.median([abs(v - med) for v in noise_vals]))
+        # Robust threshold: median + k * MAD + small buffer, clamped.
+        auto_thr = int(min(80, max(3, med + 8 * mad + 2)))
+    return best_bg, diff, auto_thr, noise_box
+
+
 def _autocrop_white_margins(
     img: Image.Image,
     *,
@@ -407,72 +837,11 @@ def _autocrop_white_margins(
         return img.crop(_expand_bbox((min_x, min_y, max_x + 1, max_y + 1)))
 
     # bg-diff mode (robust to faint vignettes / haze)
-    # Estimate background from the *whitest* corner patch (to avoid cases where a corner includes plant pixels).
-    patch = max(6, min(24, min(w, h) // 18))
-    corners: list[tuple[int, int]] = [(0, 0), (w - patch, 0), (0, h - patch), (w - patch, h - patch)]
-
-    best_bg: Optional[tuple[int, int, int]] = None
-    best_luma: float = -1.0
-
-    for cx, cy in corners:
-        crop = rgb.crop((cx, cy, cx + patch, cy + patch))
-        data = list(crop.getdata())
-        if not data:
-            continue
-        rs = [p[0] for p in data]
-        gs = [p[1] for p in data]
-        bs = [p[2] for p in data]
-        bg = (
-            int(statistics.median(rs)),
-            int(statistics.median(gs)),
-            int(statistics.median(bs)),
-        )
-        luma = (bg[0] + bg[1] + bg[2]) / 3.0
-        if luma > best_luma:
-            best_luma = luma
-            best_bg = bg
-
-    if not best_bg:
+    estimate = _estimate_background(rgb)
+    if not estimate:
         return img
-
-    bg = Image.new("RGB", rgb.size, best_bg)
-    diff = ImageChops.difference(rgb, bg).convert("L")
-    # Auto-adapt threshold based on how noisy the background is in the chosen corner patch.
-    # This prevents faint gray haze / gradients from being mistaken as "foreground" and blocking cropping.
-    corner_x, corner_y = corners[0]
-    # Recompute which corner was "best" (whitest) so we sample the same patch for noise stats.
-    # Find the corner whose median color matches best_bg the closest.
-    best_corner = corners[0]
-    best_corner_dist = 10**9
-    for cx, cy in corners:
-        crop = rgb.crop((cx, cy, cx + patch, cy + patch))
-        data = list(crop.getdata())
-        if not data:
-            continue
-        rs = [p[0] for p in data]
-        gs = [p[1] for p in data]
-        bs = [p[2] for p in data]
-        med = (
-            int(statistics.median(rs)),
-            int(statistics.median(gs)),
-            int(statistics.median(bs)),
-        )
-        dist = abs(med[0] - best_bg[0]) + abs(med[1] - best_bg[1]) + abs(med[2] - best_bg[2])
-        if dist < best_corner_dist:
-            best_corner_dist = dist
-            best_corner = (cx, cy)
-
-    corner_x, corner_y = best_corner
-    noise_patch = diff.crop((corner_x, corner_y, corner_x + patch, corner_y + patch))
-    noise_vals = list(noise_patch.getdata())
-    if noise_vals:
-        med = float(statistics.median(noise_vals))
-        mad = float(statistics.median([abs(v - med) for v in noise_vals]))
-        # Robust threshold: median + k * MAD + small buffer, clamped.
-        auto_thr = int(min(80, max(3, med + 8 * mad + 2)))
-        thr = max(int(threshold), auto_thr)
-    else:
-        thr = int(threshold)
+    _, diff, auto_thr, _ = estimate
+    thr = max(int(threshold), auto_thr) if auto_thr is not None else int(threshold)
 
     # Threshold diff into mask; bbox on the mask.
     mask = diff.point(lambda p: 255 if p > thr else 0)
@@ -490,21 +859,89 @@ def _autocrop_white_margins(
     return img.crop(_expand_bbox(bbox))
 
 
-def _maybe_autocrop_bytes(
-    img_bytes: bytes,
+def _border_connected(candidate: Image.Image, *, scale: int = FLATTEN_COARSE_SCALE) -> Image.Image:
+    """
+    Return the part of a binary "L" mask (255 = background candidate) that is connected to
+    the image border, so enclosed light regions (white/cream petals) are not treated as background.
+
+    The flood fill runs on a `scale`x reduced mask where a block counts only if every pixel in it
+    is a candidate (so the fill cannot leak through the plant), then is grown back to full
+    resolution with constrained 3x3 dilations (PIL C ops) to reach the plant edges.
+    """
+    w, h = candidate.size
+    # Box-average a 0/255 mask: a coarse pixel stays 255 only if its whole block is 255.
+    coarse = candidate.reduce(scale).point(lambda v: 255 if v == 255 else 0)
+    cw, ch = coarse.size
+    px = coarse.load()
+    border = [(x, 0) for x in range(cw)] + [(x, ch - 1) for x in range(cw)]
+    border += [(0, y) for y in range(ch)] + [(cw - 1, y) for y in range(ch)]
+    for xy in border:
+        if px[xy] == 255:
+            ImageDraw.floodfill(coarse, xy, 128, thresh=0)
+    seed = coarse.point(lambda v: 255 if v == 128 else 0).resize((w, h), Image.NEAREST)
+    seed = ImageChops.darker(seed, candidate)
+    for _ in range(scale * 2):
+        seed = ImageChops.darker(seed.filter(ImageFilter.MaxFilter(3)), candidate)
+    return seed
+
+
+def _flatten_background(
+    img: Image.Image,
     *,
-    mime_type: str,
-    enabled: bool,
-    crop_mode: str,
     threshold: int,
-    pad_px: int,
+    feather: int,
+) -> Image.Image:
+    """
+    Snap background pixels to exact white (#FFFFFF).
+
+    Uses the bg-diff background estimate, but with a per-channel max difference (so cream or
+    tinted petals stand out from neutral haze) and a tighter cutoff: `threshold` if > 0, else the
+    99th percentile of that difference in the corner noise patch, capped at FLATTEN_MAX_THRESHOLD.
+    Only background connected to the image border is touched, so light plant parts enclosed by
+    the silhouette survive. Pixels at or below the cutoff become pure white; pixels more than
+    `feather` levels above it are left untouched, with a linear blend in between so edges stay soft.
+    """
+    rgb = img.convert("RGB")
+    estimate = _estimate_background(rgb)
+    if not estimate:
+        return img
+    bg, _, _, noise_box = estimate
+    # Only flatten if the background is already near-white; otherwise the corner
+    # estimate probably landed on the plant (or the model ignored the prompt).
+    if min(bg) < FLATTEN_MIN_BG_LEVEL:
+        return img
+
+    r, g, b = ImageChops.difference(rgb, Image.new("RGB", rgb.size, bg)).split()
+    diff = ImageChops.lighter(ImageChops.lighter(r, g), b)
+    if int(threshold) > 0:
+        thr = int(threshold)
+    else:
+        noise_vals = sorted(diff.crop(noise_box).getdata())
+        thr = int(noise_vals[int(len(noise_vals) * 0.99)]) + 1 if noise_vals else 0
+    thr = min(thr, FLATTEN_MAX_THRESHOLD)
+    feather = max(1, int(feather))
+    lut = [
+        0 if v <= thr else 255 if v >= thr + feather else int(round((v - thr) * 255 / feather))
+        for v in range(256)
+    ]
+    ramp = diff.point(lut)
+    connected = _border_connected(diff.point(lambda v: 255 if v < thr + feather else 0))
+    # Keep original pixels everywhere except border-connected background (ramp there).
+    keep = ImageChops.lighter(ramp, ImageChops.invert(connected))
+    white = Image.new("RGB", rgb.size, (255, 255, 255))
+    out = Image.composite(rgb, white, keep)
+    if img.mode in ("RGBA", "LA"):
+        out.putalpha(img.getchannel("A"))
+    return out
+
+
+def _encode_image(
+    img: Image.Image,
+    *,
+    mime_type: str,
     output_format: str,
     webp_quality: int,
 ) -> bytes:
-    img = Image.open(BytesIO(img_bytes))
-    if enabled:
-        img = _autocrop_white_margins(img, mode=crop_mode, threshold=threshold, pad_px=pad_px)
-
     out = BytesIO()
 
     fmt = output_format.lower()
@@ -540,6 +977,452 @@ def _maybe_autocrop_bytes(
     return out.getvalue()
 
 
+def _postprocess_bytes(
+    img_bytes: bytes,
+    *,
+    mime_type: str,
+    enabled: bool,
+    crop_mode: str,
+    threshold: int,
+    pad_px: int,
+    output_format: str,
+    webp_quality: int,
+    flatten: bool = False,
+    flatten_threshold: int = 0,
+    flatten_feather: int = 8,
+) -> Tuple[bytes, Optional[int]]:
+    """
+    Optionally flatten the background, auto-crop, and encode the model output.
+
+    Returns (output_bytes, unflattened_size). When flattening, unflattened_size is the
+    size the output would have had without it (for reporting savings); otherwise None.
+    """
+    img = Image.open(BytesIO(img_bytes))
+    img.load()
+
+    def _crop(im: Image.Image) -> Image.Image:
+        if enabled:
+            return _autocrop_white_margins(im, mode=crop_mode, threshold=threshold, pad_px=pad_px)
+        return im
+
+    encode_kwargs = {"mime_type": mime_type, "output_format": output_format, "webp_quality": webp_quality}
+    if not flatten:
+        return _encode_image(_crop(img), **encode_kwargs), None
+
+    baseline = _encode_image(_crop(img), **encode_kwargs)
+    flat = _flatten_background(img, threshold=flatten_threshold, feather=flatten_feather)
+    return _encode_image(_crop(flat), **encode_kwargs), len(baseline)
+
+
+def _is_input_image_name(name: str, skip_preview: bool) -> bool:
+    if not _looks_like_image_path(Path(name)):
+        return False
+    if skip_preview and name.lower().endswith(".preview.jpg"):
+        return False
+    return True
+
+
+class InputWatcher:
+    """
+    Poll input_dir for new or changed photos against a persisted (mtime_ns, size) snapshot.
+
+    The directory listing is only re-read when the directory mtime changes (file added,
+    removed or renamed), while files are still settling, or every `full_rescan_s` (in-place
+    rewrites don't touch the directory mtime). A file is handed out only once it is at least
+    `settle_s` old and its size/mtime did not change since the previous poll, so partially
+    written downloads are not picked up.
+
+    Failed inputs are remembered by signature in a `failed` map: they are retried with growing
+    delays (`retry_base_s`, then x4 each time) up to `max_attempts` times, and after that only
+    once the file itself changes, so one bad photo can't be re-billed on every poll.
+    """
+
+    def __init__(
+        self,
+        *,
+        input_dir: Path,
+        skip_preview: bool,
+        state_path: Path,
+        settle_s: float,
+        full_rescan_s: float,
+        max_attempts: int = WATCH_MAX_ATTEMPTS,
+        retry_base_s: float = WATCH_RETRY_BASE_S,
+        persist: bool = True,
+    ) -> None:
+        self.input_dir = input_dir
+        self.skip_preview = skip_preview
+        self.state_path = state_path
+        self.settle_s = settle_s
+        self.full_rescan_s = full_rescan_s
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_base_s = retry_base_s
+        self.persist = persist
+        self.snapshot: Dict[str, Tuple[int, int]] = {}
+        # name -> {"sig": [mtime_ns, size], "attempts": n, "retry_at": epoch seconds}
+        self.failed: Dict[str, Dict[str, Any]] = {}
+        self._load_state()
+        self.pending: Dict[str, Tuple[int, int]] = {}
+        # Signatures of inputs handed out by poll(), recorded as-seen so later rewrites still count as changes.
+        self._handed_out: Dict[str, Tuple[int, int]] = {}
+        self._dir_mtime_ns: Optional[int] = None
+        self._last_full_scan = 0.0
+
+    def _load_state(self) -> None:
+        try:
+            data = json.loads(self.state_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("input_dir") != str(self.input_dir.resolve()):
+            return
+        files = data.get("files") or {}
+        self.snapshot = {
+            str(k): (int(v[0]), int(v[1])) for k, v in files.items() if isinstance(v, list) and len(v) == 2
+        }
+        failed = data.get("failed") or {}
+        self.failed = {
+            str(k): v
+            for k, v in failed.items()
+            if isinstance(v, dict) and isinstance(v.get("sig"), list) and len(v["sig"]) == 2
+        }
+
+    def _save_snapshot(self) -> None:
+        if not self.persist:
+            return
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "input_dir": str(self.input_dir.resolve()),
+            "files": {k: list(v) for k, v in sorted(self.snapshot.items())},
+            "failed": dict(sorted(self.failed.items())),
+        }
+        tmp = self.state_path.with_suffix(self.state_path.suffix + ".tmp")
+        tmp.write_text(json.dumps(data, indent=2), encoding="utf-8")
+        tmp.replace(self.state_path)
+
+    def _list(self) -> Dict[str, Tuple[int, int]]:
+        found: Dict[str, Tuple[int, int]] = {}
+        with os.scandir(self.input_dir) as it:
+            for entry in it:
+                if not _is_input_image_name(entry.name, self.skip_preview):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                found[entry.name] = (st.st_mtime_ns, st.st_size)
+        return found
+
+    def poll(self) -> List[Path]:
+        """Return input paths that are new or changed since the snapshot and have settled."""
+        try:
+            dir_mtime_ns = os.stat(self.input_dir).st_mtime_ns
+        except OSError:
+            return []
+        now = time.monotonic()
+        if (
+            dir_mtime_ns == self._dir_mtime_ns
+            and not self.pending
+            and now - self._last_full_scan < self.full_rescan_s
+        ):
+            return []
+        # Record the dir mtime before listing so files added mid-scan trigger another pass.
+        self._dir_mtime_ns = dir_mtime_ns
+        self._last_full_scan = now
+
+        listing = self._list()
+        removed = [name for name in self.snapshot if name not in listing]
+        removed += [name for name in self.failed if name not in listing]
+        for name in removed:
+            self.snapshot.pop(name, None)
+            self.failed.pop(name, None)
+        if removed:
+            self._save_snapshot()
+
+        ready: List[Path] = []
+        wall_now_ns = time.time_ns()
+        for name in sorted(listing):
+            sig = listing[name]
+            if self.snapshot.get(name) == sig:
+                self.pending.pop(name, None)
+                continue
+            failure = self.failed.get(name)
+            if failure is not None:
+                if tuple(failure["sig"]) != sig:
+                    # The file changed since it failed: start over with a fresh attempt budget.
+                    del self.failed[name]
+                elif int(failure.get("attempts") or 0) >= self.max_attempts or time.time() < float(
+                    failure.get("retry_at") or 0
+                ):
+                    self.pending.pop(name, None)
+                    continue
+            old_enough = wall_now_ns - sig[0] >= int(self.settle_s * 1e9)
+            unchanged = self.pending.get(name, sig) == sig
+            if old_enough and unchanged:
+                self.pending.pop(name, None)
+                self._handed_out[name] = sig
+                ready.append(self.input_dir / name)
+            else:
+                self.pending[name] = sig
+        for name in [n for n in self.pending if n not in listing]:
+            del self.pending[name]
+        return ready
+
+    def mark_done(self, paths: Iterable[Path]) -> None:
+        """Record handled inputs in the snapshot so they are not fed again until they change."""
+        for p in paths:
+            sig = self._handed_out.pop(p.name, None)
+            if sig is not None:
+                self.snapshot[p.name] = sig
+                self.failed.pop(p.name, None)
+        self._save_snapshot()
+
+    def mark_failed(self, paths: Iterable[Path]) -> None:
+        """Record failed inputs by signature and schedule their next retry (if any attempts remain)."""
+        for p in paths:
+            sig = self._handed_out.pop(p.name, None)
+            if sig is None:
+                continue
+            prev = self.failed.get(p.name)
+            attempts = int(prev.get("attempts") or 0) + 1 if prev and tuple(prev["sig"]) == sig else 1
+            delay = self.retry_base_s * (4 ** (attempts - 1))
+            self.failed[p.name] = {"sig": list(sig), "attempts": attempts, "retry_at": time.time() + delay}
+            if attempts >= self.max_attempts:
+                print(
+                    f"[WATCH] giving up on {p.name} after {attempts} failed attempt(s); "
+                    "it is retried once the file changes."
+                )
+            else:
+                print(f"[WATCH] will retry {p.name} in ~{delay / 60:.0f} min (attempt {attempts}/{self.max_attempts})")
+        self._save_snapshot()
+
+
+@dataclass
+class RunStats:
+    processed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    flatten_before_total: int = 0
+    flatten_after_total: int = 0
+
+
+@dataclass
+class GenerationContext:
+    """Per-run settings and state shared by every batch (one batch per run, or per poll in --watch)."""
+
+    args: argparse.Namespace
+    api_key: str
+    endpoint: str
+    prompt: str
+    output_dir: Path
+    usage: UsageTracker
+    files_cache: Dict[str, Dict[str, Any]]
+    files_cache_path: Path
+    session: requests.Session = field(default_factory=_make_session)
+    stats: RunStats = field(default_factory=RunStats)
+
+
+def _run_batch(ctx: GenerationContext, inputs: List[Path]) -> Tuple[List[Path], List[Path]]:
+    """
+    Generate studio images for already-scheduled inputs, in order, stopping once the budget is spent.
+
+    Returns (handled, failed): handled inputs were generated or skipped because the output
+    exists. Inputs left unprocessed by a budget stop are in neither list.
+    """
+    args = ctx.args
+    output_dir = ctx.output_dir
+    stats = ctx.stats
+    usage = ctx.usage
+    api_key = ctx.api_key
+    usage_log = Path(args.usage_log) if args.usage_log else None
+    files_api_threshold = int(float(args.files_api_threshold_mb) * 1024 * 1024)
+    handled: List[Path] = []
+    failed: List[Path] = []
+
+    for idx, img_path in enumerate(inputs):
+        scientific_name = str(args.scientific_name).strip() or _safe_stem(img_path.name)
+        per_image_prompt = _render_prompt(ctx.prompt, scientific_name=scientific_name)
+
+        existing = [p for p in _candidate_outputs(output_dir, img_path.name) if p.exists()]
+        status = _output_status(img_path, existing)
+        regenerate = bool(args.overwrite) or (bool(args.regenerate_stale) and status == "stale")
+        if existing and not regenerate:
+            stats.skipped += 1
+            handled.append(img_path)
+            print(f"[SKIP] exists: {img_path.name} -> {existing[0].name}")
+            continue
+
+        budget_reason = usage.exhausted()
+        if budget_reason:
+            print(f"[BUDGET] {budget_reason}; stopping with {len(inputs) - idx} image(s) left in the queue.")
+            return handled, failed
+
+        if args.dry_run:
+            planned = _candidate_outputs(output_dir, img_path.name)[0]
+            print(f"[DRY] would generate ({status}): {img_path.name} -> {planned.name}")
+            usage.record_attempt()
+            stats.processed += 1
+            handled.append(img_path)
+            continue
+
+        try:
+            image_bytes = img_path.read_bytes()
+            image_mime = _guess_mime_type(img_path)
+            file_uri: Optional[str] = None
+            file_name = ""
+            digest = ""
+            if args.files_api and len(image_bytes) >= files_api_threshold:
+                digest = hashlib.sha256(image_bytes).hexdigest()
+                try:
+                    file_uri = _get_or_upload_file(
+                        session=ctx.session,
+                        cache=ctx.files_cache,
+                        cache_path=ctx.files_cache_path,
+                        digest=digest,
+                        upload_url=str(args.upload_endpoint),
+                        api_key=api_key,
+                        data=image_bytes,
+                        mime_type=image_mime,
+                        display_name=img_path.name,
+                        timeout_s=args.timeout,
+                        max_retries=args.max_retries,
+                        base_sleep_s=args.base_sleep,
+                    )
+                    file_name = str((ctx.files_cache.get(digest) or {}).get("name") or "")
+                except Exception as e:
+                    print(f"[WARN] upload failed, sending inline: {img_path.name} ({e})")
+
+            payload = _build_payload(
+                prompt=per_image_prompt, image_mime=image_mime, image_bytes=image_bytes, file_uri=file_uri
+            )
+
+            try:
+                resp_json = _request_with_retries(
+                    session=ctx.session,
+                    url=ctx.endpoint,
+                    api_key=api_key,
+                    payload=payload,
+                    timeout_s=args.timeout,
+                    max_retries=args.max_retries,
+                    base_sleep_s=args.base_sleep,
+                    gzip_body=bool(args.gzip_requests),
+                    before_attempt=usage.record_attempt,
+                )
+            except RuntimeError as e:
+                # Only a 4xx naming the upload is worth an inline retry; anything else re-raises
+                # unchanged (keeping the cached URI). The failed attempts above were counted,
+                # so the budget may already be spent.
+                if (
+                    not file_uri
+                    or not _is_file_reference_error(e, file_uri=file_uri, file_name=file_name)
+                    or usage.exhausted()
+                ):
+                    raise
+                # The uploaded file may have expired or been deleted server-side; forget it and go inline.
+                print(f"[WARN] file reference rejected, retrying inline: {img_path.name} ({e})")
+                ctx.files_cache.pop(digest, None)
+                _save_files_cache(ctx.files_cache_path, ctx.files_cache)
+                payload = _build_payload(prompt=per_image_prompt, image_mime=image_mime, image_bytes=image_bytes)
+                resp_json = _request_with_retries(
+                    session=ctx.session,
+                    url=ctx.endpoint,
+                    api_key=api_key,
+                    payload=payload,
+                    timeout_s=args.timeout,
+                    max_retries=args.max_retries,
+                    base_sleep_s=args.base_sleep,
+                    gzip_body=bool(args.gzip_requests),
+                    before_attempt=usage.record_attempt,
+                )
+            resp_usage = usage.record(resp_json)
+            if usage_log:
+                _append_usage_log(
+                    usage_log,
+                    {
+                        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                        "input": img_path.name,
+                        "model": args.model,
+                        "status": status,
+                        **resp_usage,
+                    },
+                )
+
+            part = _extract_image_part(resp_json)
+            if args.output_format == "keep":
+                out_path = _choose_output_path(
+                    output_dir=output_dir, input_filename=img_path.name, out_mime=part.mime_type
+                )
+            else:
+                out_path = output_dir / f"{_safe_stem(img_path.name)}.{args.output_format}"
+
+            if out_path.exists() and not regenerate:
+                stats.skipped += 1
+                handled.append(img_path)
+                print(f"[SKIP] exists: {img_path.name} -> {out_path.name}")
+                continue
+
+            out_bytes, unflattened_size = _postprocess_bytes(
+                part.bytes(),
+                mime_type=part.mime_type,
+                enabled=bool(args.autocrop),
+                crop_mode=str(args.crop_mode),
+                threshold=int(args.crop_threshold),
+                pad_px=int(args.crop_padding),
+                output_format=str(args.output_format),
+                webp_quality=int(args.webp_quality),
+                flatten=bool(args.flatten_bg),
+                flatten_threshold=int(args.flatten_threshold),
+                flatten_feather=int(args.flatten_feather),
+            )
+            out_path.write_bytes(out_bytes)
+            stats.processed += 1
+            handled.append(img_path)
+            flatten_note = ""
+            if unflattened_size is not None:
+                stats.flatten_before_total += unflattened_size
+                stats.flatten_after_total += len(out_bytes)
+                flatten_note = f", flatten {unflattened_size / 1024:.1f}KB -> {len(out_bytes) / 1024:.1f}KB"
+            print(
+                f"[OK] generated: {img_path.name} -> {out_path.name} ({part.mime_type}, autocrop={bool(args.autocrop)}, "
+                f"tokens={resp_usage['total_tokens']}, ~${resp_usage['cost']:.4f}{flatten_note})"
+            )
+
+            if args.sleep and args.sleep > 0:
+                time.sleep(args.sleep)
+
+        except BudgetExhausted as e:
+            # Spent mid-image (failed attempts/retries count too); this input is left for a later run.
+            print(f"[BUDGET] {e}; stopping with {len(inputs) - idx} image(s) left in the queue.")
+            return handled, failed
+        except Exception as e:
+            stats.failed += 1
+            failed.append(img_path)
+            print(f"[FAIL] {img_path.name} ({e})")
+
+    return handled, failed
+
+
+def _print_summary(ctx: GenerationContext) -> None:
+    stats = ctx.stats
+    usage = ctx.usage
+    print("\n===== Studio image generation summary =====")
+    print(f"Processed: {stats.processed}")
+    print(f"Skipped:   {stats.skipped}")
+    print(f"Failed:    {stats.failed}")
+    print(f"Requests:  {usage.requests} ({usage.responses} succeeded)")
+    print(f"Tokens:    {usage.total_tokens} (prompt {usage.prompt_tokens}, output {usage.output_tokens})")
+    print(f"Est. cost: ${usage.cost:.4f}")
+    opened, sent = _connection_stats(ctx.session)
+    if sent:
+        print(f"HTTP:      {sent} request(s) over {opened} connection(s) (reuse {100.0 * (sent - opened) / sent:.1f}%)")
+    if stats.flatten_before_total:
+        saved = stats.flatten_before_total - stats.flatten_after_total
+        print(
+            f"Flatten:   {stats.flatten_before_total / 1024:.1f}KB -> {stats.flatten_after_total / 1024:.1f}KB "
+            f"(saved {saved / 1024:.1f}KB, {100.0 * saved / stats.flatten_before_total:.1f}%)"
+        )
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Generate studio plant images via Gemini (dev-only).")
     parser.add_argument("--input-dir", default="images", help="Directory containing input photos (default: images)")
@@ -562,6 +1445,31 @@ def main() -> int:
         default=None,
         help="Override full REST endpoint URL (default: derived from --model)",
     )
+    parser.add_argument(
+        "--upload-endpoint",
+        default=DEFAULT_UPLOAD_ENDPOINT,
+        help="Files API upload URL (default: Gemini Files API).",
+    )
+    parser.add_argument(
+        "--files-api",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help=(
+            "Upload inputs larger than --files-api-threshold-mb via the Files API and reference them by URI "
+            "instead of inlining base64 (default: true). Use --no-files-api to always inline."
+        ),
+    )
+    parser.add_argument(
+        "--files-api-threshold-mb",
+        type=float,
+        default=4.0,
+        help="Input size (MB) at or above which the Files API is used (default: 4).",
+    )
+    parser.add_argument(
+        "--files-cache",
+        default=str(DEFAULT_FILES_CACHE),
+        help="JSON cache of uploaded file URIs keyed by input sha256 (default: next to this script).",
+    )
     parser.add_argument("--prompt-file", default=None, help="Path to a text file containing the prompt.")
     parser.add_argument(
         "--scientific-name",
@@ -602,6 +1510,30 @@ def main() -> int:
         default=24,
         help="Extra pixels to keep around the detected plant bounds (default: 24).",
     )
+    parser.add_argument(
+        "--flatten-bg",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help=(
+            "Snap near-white background haze/noise to exact #FFFFFF before cropping (default: false). "
+            "Reports before/after output size (costs one extra encode per image)."
+        ),
+    )
+    parser.add_argument(
+        "--flatten-threshold",
+        type=int,
+        default=0,
+        help=(
+            "0..255 per-channel difference from the background at or below which border-connected "
+            "background becomes pure white (default: 0 = measured from corner noise; capped at 24)."
+        ),
+    )
+    parser.add_argument(
+        "--flatten-feather",
+        type=int,
+        default=8,
+        help="Width (in diff levels) of the soft blend between background and plant (default: 8).",
+    )
     parser.add_argument(
         "--output-format",
         choices=["webp", "jpg", "png", "keep"],
@@ -614,11 +1546,93 @@ def main() -> int:
         default=90,
         help="WebP quality 0..100 (default: 90). Only used when --output-format=webp.",
     )
+    parser.add_argument(
+        "--priority-list",
+        default=None,
+        help=(
+            "Optional text file of filenames to process first, in file order "
+            "(e.g. the output of select_pa_missing_studio_images.js). Same line format as --input-list."
+        ),
+    )
+    parser.add_argument(
+        "--regenerate-stale",
+        action="store_true",
+        help="Regenerate outputs older than their input photo (scheduled after missing ones).",
+    )
     parser.add_argument("--limit", type=int, default=0, help="Process at most N images (0 = no limit).")
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=0,
+        help="Stop cleanly after N API requests this run (0 = no limit).",
+    )
+    parser.add_argument(
+        "--max-cost",
+        type=float,
+        default=0.0,
+        help="Stop cleanly once estimated spend (USD) reaches this amount (0 = no limit).",
+    )
+    parser.add_argument(
+        "--input-cost",
+        type=float,
+        default=DEFAULT_INPUT_COST_PER_MTOK,
+        help=f"USD per 1M prompt tokens for cost estimates (default: {DEFAULT_INPUT_COST_PER_MTOK}).",
+    )
+    parser.add_argument(
+        "--output-cost",
+        type=float,
+        default=DEFAULT_OUTPUT_COST_PER_MTOK,
+        help=f"USD per 1M output tokens for cost estimates (default: {DEFAULT_OUTPUT_COST_PER_MTOK}).",
+    )
+    parser.add_argument(
+        "--usage-log",
+        default=None,
+        help="Optional JSONL file to append per-response token usage to.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Keep running and process new or changed photos in --input-dir as they appear "
+            "(--limit is ignored; use --max-requests/--max-cost to bound the run)."
+        ),
+    )
+    parser.add_argument("--watch-interval", type=float, default=30.0, help="Seconds between polls (default: 30).")
+    parser.add_argument(
+        "--watch-settle",
+        type=float,
+        default=10.0,
+        help="Only pick up files unchanged for at least this many seconds (default: 10).",
+    )
+    parser.add_argument(
+        "--watch-rescan",
+        type=float,
+        default=600.0,
+        help="Re-list the directory at least this often to catch in-place rewrites (default: 600).",
+    )
+    parser.add_argument(
+        "--watch-max-attempts",
+        type=int,
+        default=WATCH_MAX_ATTEMPTS,
+        help=(
+            f"Attempts per unchanged photo before --watch gives up on it until the file changes "
+            f"(default: {WATCH_MAX_ATTEMPTS}). Retries wait 15 min, then 4x longer each time."
+        ),
+    )
+    parser.add_argument(
+        "--watch-state",
+        default=str(DEFAULT_WATCH_STATE),
+        help="JSON snapshot of already-handled inputs for --watch (default: next to this script).",
+    )
     parser.add_argument("--dry-run", action="store_true", help="List planned work but do not call the API/write files.")
     parser.add_argument("--timeout", type=int, default=120, help="HTTP timeout seconds (default: 120).")
     parser.add_argument("--max-retries", type=int, default=3, help="Retries for transient errors (default: 3).")
     parser.add_argument("--base-sleep", type=float, default=1.0, help="Base sleep for retry backoff (default: 1.0).")
+    parser.add_argument(
+        "--gzip-requests",
+        action="store_true",
+        help="Gzip generateContent request bodies (Content-Encoding: gzip); only if the endpoint accepts it.",
+    )
     parser.add_argument("--sleep", type=float, default=0.0, help="Sleep seconds between successful requests (default: 0).")
 
     args = parser.parse_args()
@@ -645,9 +1659,62 @@ def main() -> int:
         "https://generativelanguage.googleapis.com/v1beta/models/" f"{args.model}:generateContent"
     )
 
-    processed = 0
-    skipped = 0
-    failed = 0
+    ctx = GenerationContext(
+        args=args,
+        api_key=api_key or "",
+        endpoint=endpoint,
+        prompt=prompt,
+        output_dir=output_dir,
+        usage=UsageTracker(
+            input_cost_per_mtok=float(args.input_cost),
+            output_cost_per_mtok=float(args.output_cost),
+            max_requests=int(args.max_requests),
+            max_cost=float(args.max_cost),
+        ),
+        files_cache=_load_files_cache(Path(args.files_cache)) if args.files_api else {},
+        files_cache_path=Path(args.files_cache),
+    )
+
+    priority_ranks: Dict[str, int] = {}
+    if args.priority_list:
+        try:
+            priority_ranks = _load_priority_ranks(Path(args.priority_list))
+        except FileNotFoundError as e:
+            print(f"ERROR: {e}")
+            return 2
+
+    if args.watch:
+        if args.input_list:
+            print("ERROR: --watch monitors --input-dir and cannot be combined with --input-list.")
+            return 2
+        watcher = InputWatcher(
+            input_dir=input_dir,
+            skip_preview=args.skip_preview,
+            state_path=Path(args.watch_state),
+            settle_s=float(args.watch_settle),
+            full_rescan_s=float(args.watch_rescan),
+            max_attempts=int(args.watch_max_attempts),
+            # Dry runs must not mark anything as done.
+            persist=not args.dry_run,
+        )
+        print(f"[WATCH] polling {input_dir} every {args.watch_interval}s (Ctrl+C to stop)")
+        try:
+            while True:
+                ready = watcher.poll()
+                if ready:
+                    batch = _schedule_inputs(ready, output_dir=output_dir, priority_ranks=priority_ranks)
+                    print(f"[WATCH] {len(batch)} new/changed input(s)")
+                    handled, failed = _run_batch(ctx, batch)
+                    watcher.mark_done(handled)
+                    watcher.mark_failed(failed)
+                    if ctx.usage.exhausted():
+                        break
+                time.sleep(float(args.watch_interval))
+        except KeyboardInterrupt:
+            print("\n[WATCH] stopped.")
+        _print_summary(ctx)
+        ctx.session.close()
+        return 1 if ctx.stats.failed else 0
 
     if args.input_list:
         input_list_path = Path(args.input_list)
@@ -671,6 +1738,7 @@ def main() -> int:
             )
     else:
         inputs = list(iter_input_images(input_dir=input_dir, output_dir=output_dir, skip_preview=args.skip_preview))
+    inputs = _schedule_inputs(inputs, output_dir=output_dir, priority_ranks=priority_ranks)
     if args.limit and args.limit > 0:
         inputs = inputs[: args.limit]
 
@@ -678,78 +1746,10 @@ def main() -> int:
         print("No input images found.")
         return 0
 
-    for img_path in inputs:
-        scientific_name = str(args.scientific_name).strip() or _safe_stem(img_path.name)
-        per_image_prompt = _render_prompt(prompt, scientific_name=scientific_name)
-
-        existing = [p for p in _candidate_outputs(output_dir, img_path.name) if p.exists()]
-        if existing and not args.overwrite:
-            skipped += 1
-            print(f"[SKIP] exists: {img_path.name} -> {existing[0].name}")
-            continue
-
-        if args.dry_run:
-            planned = _candidate_outputs(output_dir, img_path.name)[0]
-            print(f"[DRY] would generate: {img_path.name} -> {planned.name}")
-            processed += 1
-            continue
-
-        try:
-            image_bytes = img_path.read_bytes()
-            image_mime = _guess_mime_type(img_path)
-            payload = _build_payload(prompt=per_image_prompt, image_mime=image_mime, image_bytes=image_bytes)
-
-            resp_json = _request_with_retries(
-                url=endpoint,
-                api_key=api_key or "",
-                payload=payload,
-                timeout_s=args.timeout,
-                max_retries=args.max_retries,
-                base_sleep_s=args.base_sleep,
-            )
-
-            part = _extract_image_part(resp_json)
-            if args.output_format == "keep":
-                out_path = _choose_output_path(
-                    output_dir=output_dir, input_filename=img_path.name, out_mime=part.mime_type
-                )
-            else:
-                out_path = output_dir / f"{_safe_stem(img_path.name)}.{args.output_format}"
-
-            if out_path.exists() and not args.overwrite:
-                skipped += 1
-                print(f"[SKIP] exists: {img_path.name} -> {out_path.name}")
-                continue
-
-            out_bytes = _maybe_autocrop_bytes(
-                part.bytes(),
-                mime_type=part.mime_type,
-                enabled=bool(args.autocrop),
-                crop_mode=str(args.crop_mode),
-                threshold=int(args.crop_threshold),
-                pad_px=int(args.crop_padding),
-                output_format=str(args.output_format),
-                webp_quality=int(args.webp_quality),
-            )
-            out_path.write_bytes(out_bytes)
-            processed += 1
-            print(
-                f"[OK] generated: {img_path.name} -> {out_path.name} ({part.mime_type}, autocrop={bool(args.autocrop)})"
-            )
-
-            if args.sleep and args.sleep > 0:
-                time.sleep(args.sleep)
-
-        except Exception as e:
-            failed += 1
-            print(f"[FAIL] {img_path.name} ({e})")
-
-    print("\n===== Studio image generation summary =====")
-    print(f"Processed: {processed}")
-    print(f"Skipped:   {skipped}")
-    print(f"Failed:    {failed}")
-
-    return 1 if failed else 0
+    _run_batch(ctx, inputs)
+    _print_summary(ctx)
+    ctx.session.close()
+    return 1 if ctx.stats.failed else 0
 
 
 if __name__ == "__main__":